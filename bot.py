@@ -1,6 +1,7 @@
  
 import logging
 import os
+import sys
 import asyncio
 import threading
 from telegram.ext import Application
@@ -8,6 +9,8 @@ from handlers.start import start_handler
 from handlers.leech import leech_handler
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from handlers.set_commands import set_bot_commands # Corrected import path
+from services.downloader import close_client
+from services.terabox import cleanup_resolver
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -15,6 +18,15 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# uvloop speeds up socket readiness and timer dispatch on the download path;
+# it is POSIX-only, so Windows keeps the default loop
+if sys.platform != "win32":
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        logger.info("uvloop not installed, using the default asyncio event loop")
+
 # HTTP server for health check (remains as a separate thread)
 class HealthHandler(BaseHTTPRequestHandler):
     def do_GET(self):
@@ -35,6 +47,11 @@ def run_health_server():
 async def error_handler(update, context):
     logger.error(f"Exception while handling update: {context.error}")
 
+async def on_shutdown(application):
+    # Close pooled download and resolver connections
+    await close_client()
+    await cleanup_resolver()
+
 def main():
     bot_token = os.getenv("BOT_TOKEN")
     if not bot_token:
@@ -46,7 +63,7 @@ def main():
     health_thread.start()
 
     logger.info("Starting Terabox Leech Bot with leech handler and error handling...")
-    app = Application.builder().token(bot_token).build()
+    app = Application.builder().token(bot_token).post_shutdown(on_shutdown).build()
 
     # Register your handlers
     app.add_handler(start_handler)
@@ -1,11 +1,13 @@
 import os
+import re
 import time
+import asyncio
 import logging
 import psutil
 from telegram import Update
 from telegram.ext import ContextTypes, CommandHandler
 
-from services.terabox import get_resolver, cleanup_resolver
+from services.terabox import get_resolver, forget_resolved
 from services.downloader import fetch_to_temp
 from services.uploader import stream_upload_media
 from handlers.verification import (
@@ -21,17 +23,53 @@ logger = logging.getLogger(__name__)
 MAX_FILE_SIZE = 120 * 1024 * 1024  # 120MB
 MIN_MEMORY_MB = 150
 PRIVATE_CHANNEL_ID = int(os.environ.get("PRIVATE_CHANNEL_ID", 0))
+PROGRESS_EDIT_INTERVAL = 3.0  # Seconds between status edits; Telegram flood-limits faster edits
+_TERABOX_LINK_RE = re.compile(r"terabox|1024tera", re.IGNORECASE)
+
+
+_SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB', 'PB')
 
 
 def _fmt_size(n: int = None) -> str:
     if n is None:
         return "unknown"
-    f = float(n)
-    for u in ['B', 'KB', 'MB', 'GB', 'TB']:
-        if f < 1024:
-            return f"{f:.2f} {u}"
-        f /= 1024
-    return f"{f:.2f} PB"
+    i = min(max(0, (int(n).bit_length() - 1) // 10), len(_SIZE_UNITS) - 1)
+    return f"{n / (1 << (10 * i)):.2f} {_SIZE_UNITS[i]}"
+
+
+def _progress_editor(status, filename: str):
+    """
+    Build an on_progress callback that edits the status message at most every
+    PROGRESS_EDIT_INTERVAL, plus a finish() coroutine to await before the final
+    status edit so a late progress edit cannot overwrite it
+    """
+    last_edit = 0.0
+    in_flight = None
+    finished = False
+
+    async def edit(text: str):
+        try:
+            await status.edit_text(text)
+        except Exception as e:
+            logger.debug(f"Progress edit skipped: {e}")
+
+    def on_progress(done: int, total: int = None):
+        nonlocal last_edit, in_flight
+        now = time.monotonic()
+        if finished or now - last_edit < PROGRESS_EDIT_INTERVAL or (in_flight and not in_flight.done()):
+            return
+        last_edit = now
+        percent = f" ({done * 100 // total}%)" if total else ""
+        in_flight = asyncio.create_task(edit(f"Downloading {filename} {_fmt_size(done)} / {_fmt_size(total)}{percent}"))
+
+    async def finish():
+        # Awaited, not cancelled: a request already sent to Telegram can still land
+        nonlocal finished
+        finished = True
+        if in_flight:
+            await in_flight
+
+    return on_progress, finish
 
 
 async def phase21_leech_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -60,17 +98,14 @@ async def phase21_leech_handler(update: Update, context: ContextTypes.DEFAULT_TY
         url = parts[1].strip()
         chat_id = update.effective_chat.id
 
-        if not any(d in url.lower() for d in ("terabox", "1024tera")):
+        if not _TERABOX_LINK_RE.search(url):
             await update.message.reply_text("Invalid Terabox link.")
             return
 
         status = await update.message.reply_text("Resolving Terabox link...")
 
         resolver = await get_resolver()
-        try:
-            file_meta = await resolver.resolve(url)
-        finally:
-            await cleanup_resolver()
+        file_meta = await resolver.resolve(url)
 
         download_url = file_meta.url
         filename = file_meta.name
@@ -91,11 +126,20 @@ async def phase21_leech_handler(update: Update, context: ContextTypes.DEFAULT_TY
 
         await status.edit_text(f"Downloading {filename} {_fmt_size(filesize)}")
 
+        on_progress, finish_progress = _progress_editor(status, filename)
         start_time = time.time()
-        temp_path, _ = await fetch_to_temp(file_meta, on_progress=status.edit_text)
+        try:
+            temp_path, _ = await fetch_to_temp(file_meta, on_progress=on_progress)
+        except Exception:
+            # The signed link may be what failed; a retry must resolve a fresh one
+            forget_resolved(url)
+            raise
+        finally:
+            await finish_progress()
         elapsed = time.time() - start_time
 
         if not temp_path:
+            forget_resolved(url)
             await status.edit_text("Download failed or timed out.")
             return
 
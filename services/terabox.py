@@ -1,7 +1,7 @@
 # services/terabox.py
 
 import asyncio
-import json
+import os
 import re
 import httpx
 import random
@@ -9,8 +9,11 @@ import time
 import logging
 import gzip
 import io
-from urllib.parse import urlparse, parse_qs
-from services.downloader import FileMeta
+from typing import Optional
+from urllib.parse import urlparse, parse_qs, quote
+from services.downloader import FileMeta, retry_after_seconds
+
+logger = logging.getLogger(__name__)
 
 # Try to import brotli
 try:
@@ -18,65 +21,135 @@ try:
     HAS_BROTLI = True
 except ImportError:
     HAS_BROTLI = False
-    print("⚠️ WARNING: brotli not installed. Brotli decompression will not work.")
+    logger.warning("⚠️ brotli not installed. Brotli decompression will not work.")
 
-logger = logging.getLogger(__name__)
+# httpx decodes br itself when brotli is importable; only advertise what it can decode
+_ACCEPT_ENCODING = "br, gzip, deflate" if HAS_BROTLI else "gzip, deflate"
+
+# Sent once as client defaults; API calls pass no per-request headers
+_API_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36",
+    "Accept": "application/json, text/plain, */*",
+    "Accept-Language": "en-US,en;q=0.9",
+    "Accept-Encoding": _ACCEPT_ENCODING,
+    "DNT": "1",
+    "Connection": "keep-alive",
+    "Referer": "https://www.terabox.com/",
+}
+
+# orjson parses API payloads faster; fall back to the stdlib parser
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+    _json_loads = json.loads
 
 # The API endpoint
 WDZONE_API = "https://wdzone-terabox-api.vercel.app/api"
+MAX_CONCURRENT_RESOLVES = int(os.environ.get("TERABOX_MAX_RESOLVES", "5"))
+RESOLVE_CACHE_TTL = float(os.environ.get("TERABOX_RESOLVE_TTL", "300"))  # Seconds; 0 disables
+RESOLVE_CACHE_SIZE = 256
+
+# Retries for 429/5xx API answers: jittered exponential backoff, Retry-After wins
+API_MAX_ATTEMPTS = 3
+API_BACKOFF_BASE = 1.0
+API_BACKOFF_CAP = 30.0
+
+# share_url -> (expires_at, name, size, url); a retried link skips the API call
+_resolve_cache: dict[str, tuple[float, str, Optional[int], str]] = {}
+
+# Fallback key chains for the fields of an "📜 Extracted Info" entry
+_DLINK_KEYS = ("🔽 Direct Download Link", "download_url", "downloadUrl", "url", "dlink")
+_NAME_KEYS = ("📂 Title",)
+_SIZE_KEYS = ("📏 Size", "size")
+
+
+def _first_value(info: dict, keys: tuple):
+    """Return the first truthy value of info among keys, in order."""
+    return next((info[k] for k in keys if info.get(k)), None)
+
+# Shared client: resolves reuse pooled keep-alive connections to the API
+_client_instance = None
+
+async def get_client() -> httpx.AsyncClient:
+    global _client_instance
+    if _client_instance is None:
+        _client_instance = httpx.AsyncClient(
+            timeout=60.0,
+            follow_redirects=True,
+            headers=_API_HEADERS,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+            http2=True
+        )
+    return _client_instance
+
+async def close_client():
+    global _client_instance
+    if _client_instance:
+        await _client_instance.aclose()
+        _client_instance = None
+
+def _make_meta(url: str, name: Optional[str], size) -> FileMeta:
+    """FileMeta with the default name; size may be an int, a numeric string or None"""
+    if not isinstance(size, int):
+        size = int(size) if size else None
+    return FileMeta(name=name or "terabox_file.mp4", size=size or None, url=url)
+
+def _cache_resolved(share_url: str, meta: FileMeta):
+    if RESOLVE_CACHE_TTL <= 0:
+        return
+    now = time.monotonic()
+    if len(_resolve_cache) >= RESOLVE_CACHE_SIZE:
+        for key in [k for k, v in _resolve_cache.items() if v[0] <= now]:
+            del _resolve_cache[key]
+        if len(_resolve_cache) >= RESOLVE_CACHE_SIZE:
+            del _resolve_cache[next(iter(_resolve_cache))]  # Oldest insert
+    _resolve_cache[share_url] = (now + RESOLVE_CACHE_TTL, meta.name, meta.size, meta.url)
+
+def forget_resolved(share_url: str):
+    """Drop a cached link, e.g. after its download failed, so the next resolve asks the API again"""
+    _resolve_cache.pop(share_url.strip(), None)
 
 class TeraboxResolver:
     def __init__(self):
-        self._client = None
-        self._lock = asyncio.Lock()
+        # Bounds in-flight API calls without serializing every user behind one lock
+        self._slots = asyncio.Semaphore(MAX_CONCURRENT_RESOLVES)
 
     async def get_client(self):
-        if self._client is None:
-            self._client = httpx.AsyncClient(
-                timeout=60.0,
-                follow_redirects=True,
-                headers={
-                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36",
-                    "Accept": "application/json, text/plain, */*",
-                    "Accept-Language": "en-US,en;q=0.9",
-                    "Accept-Encoding": "gzip, deflate, br",
-                    "DNT": "1",
-                    "Connection": "keep-alive",
-                    "Referer": "https://www.terabox.com/",
-                },
-                limits=httpx.Limits(max_keepalive_connections=5, max_connections=10)
-            )
-        return self._client
+        return await get_client()
 
     async def close(self):
-        if self._client:
-            await self._client.aclose()
-            self._client = None
+        await close_client()
 
     async def resolve(self, share_url: str) -> FileMeta:
-        async with self._lock:
+        # Same key the API call uses, so pasted whitespace still hits the cache
+        share_url = share_url.strip()
+        # Fresh FileMeta per hit: downloads fill in size and digest on it
+        hit = _resolve_cache.get(share_url)
+        if hit and hit[0] > time.monotonic():
+            logger.info("♻️ TeraboxResolver: Cached link for %s", share_url)
+            return _make_meta(hit[3], hit[1], hit[2])
+        
+        async with self._slots:
             try:
-                await asyncio.sleep(random.uniform(1.0, 2.0))
-                logger.info(f"🌐 TeraboxResolver: Processing {share_url}")
+                logger.info("🌐 TeraboxResolver: Processing %s", share_url)
                 
                 # Use wdzone API
                 download_url, filename, filesize = await self._wdzone_api_method(share_url)
                 
                 if download_url:
-                    logger.info(f"✅ TeraboxResolver: SUCCESS - {filename} ({filesize} bytes)")
-                    return FileMeta(
-                        name=filename or "terabox_file.mp4",
-                        size=int(filesize) if filesize else None,
-                        url=download_url
-                    )
+                    logger.info("✅ TeraboxResolver: SUCCESS - %s (%s bytes)", filename, filesize)
+                    meta = _make_meta(download_url, filename, filesize)
+                    _cache_resolved(share_url, meta)
+                    return meta
                 
-                logger.error(f"❌ TeraboxResolver: No download URL found")
+                logger.error("❌ TeraboxResolver: No download URL found")
                 raise RuntimeError("Link expired or invalid. Please get a fresh link from Terabox.")
                 
             except Exception as e:
-                await self.close()
                 error_msg = str(e).lower()
-                logger.error(f"❌ TeraboxResolver: Error - {e}")
+                logger.error("❌ TeraboxResolver: Error - %s", e)
                 
                 if any(x in error_msg for x in ["expired", "invalid", "private"]):
                     raise RuntimeError("Link expired or invalid. Please get a fresh link from Terabox.")
@@ -110,43 +183,33 @@ class TeraboxResolver:
             return int(number * multipliers.get(unit, 1))
             
         except Exception as e:
-            logger.warning(f"⚠️ Size parsing error: {e}")
+            logger.warning("⚠️ Size parsing error: %s", e)
             return None
 
     def _decode_response_content(self, response):
         """Safely decode response content handling Brotli, Gzip, and plain text"""
         try:
             content_encoding = response.headers.get('content-encoding', '').lower()
-            logger.info(f"📦 Content-Encoding: {content_encoding}")
+            logger.debug("📦 Content-Encoding: %s", content_encoding)
             
             raw_content = response.content
-            logger.info(f"📦 Raw content length: {len(raw_content)} bytes")
+            logger.debug("📦 Raw content length: %d bytes", len(raw_content))
             
-            # Handle Brotli compression (BR)
-            if content_encoding == 'br':
-                logger.info(f"🗜️ Decompressing Brotli content...")
-                if HAS_BROTLI:
-                    try:
-                        decompressed = brotli.decompress(raw_content)
-                        decoded = decompressed.decode('utf-8')
-                        logger.info(f"✅ Brotli decompressed and decoded: {len(decoded)} chars")
-                        return decoded
-                    except Exception as e:
-                        logger.error(f"❌ Brotli decompression failed: {e}")
-                else:
-                    logger.error(f"❌ Brotli compression detected but brotli package not available!")
-                    return None
+            # httpx already decoded br/gzip/deflate; br is only left raw without brotli
+            if content_encoding == 'br' and not HAS_BROTLI:
+                logger.error("❌ Brotli compression detected but brotli package not available!")
+                return None
             
-            # Handle Gzip compression
-            elif content_encoding == 'gzip' or raw_content.startswith(b'\x1f\x8b'):
-                logger.info(f"🗜️ Decompressing gzip content...")
+            # Handle gzip bodies sent without a Content-Encoding header
+            if raw_content.startswith(b'\x1f\x8b'):
+                logger.debug("🗜️ Decompressing gzip content...")
                 try:
                     decompressed = gzip.decompress(raw_content)
                     decoded = decompressed.decode('utf-8')
-                    logger.info(f"✅ Gzip decompressed and decoded: {len(decoded)} chars")
+                    logger.debug("✅ Gzip decompressed and decoded: %d chars", len(decoded))
                     return decoded
                 except Exception as e:
-                    logger.error(f"❌ Gzip decompression failed: {e}")
+                    logger.error("❌ Gzip decompression failed: %s", e)
             
             # Try direct decoding with different encodings
             for encoding in ['utf-8', 'latin-1', 'ascii']:
@@ -154,7 +217,7 @@ class TeraboxResolver:
                     decoded = raw_content.decode(encoding)
                     # Validate that it looks like JSON
                     if decoded.strip().startswith('{') and decoded.strip().endswith('}'):
-                        logger.info(f"✅ Direct decode with {encoding}: {len(decoded)} chars")
+                        logger.debug("✅ Direct decode with %s: %d chars", encoding, len(decoded))
                         return decoded
                 except UnicodeDecodeError:
                     continue
@@ -163,16 +226,16 @@ class TeraboxResolver:
             try:
                 text = response.text
                 if text.strip().startswith('{') and text.strip().endswith('}'):
-                    logger.info(f"✅ Using response.text: {len(text)} chars")
+                    logger.debug("✅ Using response.text: %d chars", len(text))
                     return text
             except Exception:
                 pass
             
-            logger.error(f"❌ All decoding methods failed")
+            logger.error("❌ All decoding methods failed")
             return None
             
         except Exception as e:
-            logger.error(f"❌ Content decoding error: {e}")
+            logger.error("❌ Content decoding error: %s", e)
             return None
 
     async def _wdzone_api_method(self, url: str):
@@ -181,87 +244,92 @@ class TeraboxResolver:
             client = await self.get_client()
             clean_url = url.strip()
             
-            logger.info(f"🌐 Calling wdzone API with: {clean_url}")
+            logger.info("🌐 Calling wdzone API with: %s", clean_url)
+            # Encoded once, reused by every retry below
+            api_url = f"{WDZONE_API}?url={quote(clean_url, safe='')}"
             
-            # Make API request
-            response = await client.get(
-                WDZONE_API,
-                params={"url": clean_url},
-                timeout=30
-            )
+            # Make API request; back off only when the API is throttling or failing
+            for attempt in range(API_MAX_ATTEMPTS):
+                response = await client.get(api_url, timeout=30)
+                if response.status_code != 429 and response.status_code < 500:
+                    break
+                if attempt + 1 < API_MAX_ATTEMPTS:
+                    delay = retry_after_seconds(response) or min(
+                        API_BACKOFF_CAP, API_BACKOFF_BASE * 2 ** attempt * (1 + random.random() * 0.5)
+                    )
+                    logger.warning("⚠️ API returned %s, retrying in %.1fs", response.status_code, delay)
+                    await asyncio.sleep(delay)
             
-            logger.info(f"📡 API Response Status: {response.status_code}")
+            logger.debug("📡 API Response Status: %d", response.status_code)
             
-            if response.status_code != 200:
-                logger.error(f"❌ API returned {response.status_code}")
+            if not response.is_success:
+                logger.error("❌ API returned %s", response.status_code)
                 return None, None, None
             
             # Decode response content
             text_content = self._decode_response_content(response)
             if not text_content:
-                logger.error(f"❌ Could not decode response content")
+                logger.error("❌ Could not decode response content")
                 return None, None, None
             
-            logger.info(f"📄 Decoded content preview: {text_content[:200]}...")
+            logger.debug("📄 Decoded content preview: %.200s...", text_content)
             
             # Parse JSON
             try:
-                data = json.loads(text_content)
-                logger.info(f"📋 JSON parsed successfully, keys: {list(data.keys())}")
-            except json.JSONDecodeError as e:
-                logger.error(f"❌ JSON parsing failed: {e}")
+                data = _json_loads(text_content)
+                logger.debug("📋 JSON parsed successfully, keys: %s", data.keys())
+            except ValueError as e:  # Both parsers' JSONDecodeError subclass ValueError
+                logger.error("❌ JSON parsing failed: %s", e)
                 return None, None, None
             
             # Check API status
             status = data.get("✅ Status") or data.get("status")
-            logger.info(f"📊 API Status: {status}")
+            logger.debug("📊 API Status: %s", status)
             
             if status != "Success":
-                logger.error(f"❌ API Status not Success: {status}")
+                logger.error("❌ API Status not Success: %s", status)
                 return None, None, None
             
             # Extract file info
             extracted_info = data.get("📜 Extracted Info")
-            logger.info(f"📝 Extracted Info type: {type(extracted_info)}")
+            logger.debug("📝 Extracted Info type: %s", type(extracted_info))
             
             if not extracted_info:
-                logger.error(f"❌ No extracted info in response")
+                logger.error("❌ No extracted info in response")
                 return None, None, None
             
             # Handle different response formats
             if isinstance(extracted_info, list) and len(extracted_info) > 0:
                 file_info = extracted_info[0]
-                logger.info(f"📁 Processing file from list, keys: {list(file_info.keys())}")
+                logger.debug("📁 Processing file from list, keys: %s", file_info.keys())
             elif isinstance(extracted_info, dict):
                 file_info = extracted_info
-                logger.info(f"📁 Processing dict file, keys: {list(file_info.keys())}")
+                logger.debug("📁 Processing dict file, keys: %s", file_info.keys())
             else:
-                logger.error(f"❌ Unexpected extracted_info format: {type(extracted_info)}")
+                logger.error("❌ Unexpected extracted_info format: %s", type(extracted_info))
                 return None, None, None
             
             # Extract the actual data using exact keys from API response
-            download_url = file_info.get("🔽 Direct Download Link")
-            filename = file_info.get("📂 Title")
-            file_size_str = file_info.get("📏 Size") or file_info.get("size")
+            download_url = _first_value(file_info, _DLINK_KEYS)
+            filename = _first_value(file_info, _NAME_KEYS)
+            file_size_str = _first_value(file_info, _SIZE_KEYS)
             
-            logger.info(f"📄 Extracted - URL exists: {download_url is not None}")
-            logger.info(f"📄 Extracted - Name: {filename}")
-            logger.info(f"📄 Extracted - Size string: {file_size_str}")
+            logger.debug("📄 Extracted - URL exists: %s", download_url is not None)
+            logger.debug("📄 Extracted - Name: %s", filename)
+            logger.debug("📄 Extracted - Size string: %s", file_size_str)
             
             # Parse size to bytes
             filesize_bytes = self._parse_size_string(file_size_str)
             
             if download_url and filename:
-                logger.info(f"✅ All required fields found")
+                logger.debug("✅ All required fields found")
                 return download_url, filename, filesize_bytes
             else:
-                logger.error(f"❌ Missing required fields")
+                logger.error("❌ Missing required fields")
                 return None, None, None
                 
         except Exception as e:
-            logger.error(f"❌ wdzone API exception: {e}")
-            import traceback
-            logger.error(f"❌ Full traceback: {traceback.format_exc()}")
+            logger.error("❌ wdzone API exception: %s", e, exc_info=True)
             return None, None, None
 
 # Global resolver instance
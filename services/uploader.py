@@ -25,6 +25,11 @@ class StreamingFileReader:
     
     def __enter__(self):
         self._file_handle = open(self.file_path, 'rb')
+        # Read front to back once: ask for aggressive readahead on this fd
+        try:
+            os.posix_fadvise(self._file_handle.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except (AttributeError, OSError):
+            pass
         logger.info(f"📂 File handle opened for streaming upload")
         return self
     
@@ -76,13 +81,12 @@ class StreamingFileReader:
             self._file_handle.close()
             self._file_handle = None
 
+_SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
+
 def _format_size(bytes_count: int) -> str:
     """Format bytes to human readable"""
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if bytes_count < 1024.0:
-            return f"{bytes_count:.1f} {unit}"
-        bytes_count /= 1024.0
-    return f"{bytes_count:.1f} TB"
+    idx = min(max(0, (int(bytes_count).bit_length() - 1) // 10), len(_SIZE_UNITS) - 1)
+    return f"{bytes_count / (1 << (10 * idx)):.1f} {_SIZE_UNITS[idx]}"
 
 def probe_video_info(file_path: str) -> dict:
     """Get video information using ffprobe"""